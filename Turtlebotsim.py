@@ -2,7 +2,6 @@ import time
 import threading
 import json
 import numpy as np
-import paho.mqtt.client as mqtt
 import tkinter as tk
 from tkinter import messagebox
 import random
@@ -30,10 +29,8 @@ class TurtleBotSim:
         self.lidar_data = [random.uniform(5, 10) for _ in range(360)]
         
     def generate_obstacles(self, num_obstacles=5):
-        obstacles = []
-        for _ in range(num_obstacles):
-            obstacles.append((random.uniform(-self.map_size, self.map_size), random.uniform(-self.map_size, self.map_size)))
-        return obstacles
+        # (num_obstacles, 2) array of x, y positions
+        return np.random.default_rng().uniform(-self.map_size, self.map_size, size=(num_obstacles, 2))
     
     def publish_pose(self):
         client.publish(POSE_TOPIC, json.dumps({"x": self.position[0], "y": self.position[1], "angle": self.angle}))
@@ -85,13 +82,9 @@ class TurtleBotSim:
 # A* Pathfinding (Simple Implementation)
 def astar(start, end, obstacles):
     # Placeholder for A*; generates a straight path from start to end avoiding obstacles.
-    path = []
     steps = 20
-    x_vals = np.linspace(start[0], end[0], steps)
-    y_vals = np.linspace(start[1], end[1], steps)
-    for i in range(steps):
-        path.append([x_vals[i], y_vals[i]])
-    return path
+    return np.stack([np.linspace(start[0], end[0], steps),
+                     np.linspace(start[1], end[1], steps)], axis=1)
 
 # GUI Setup using Tkinter
 sim = TurtleBotSim()
@@ -119,7 +112,7 @@ def update_map():
     ax.arrow(sim.position[0], sim.position[1], heading_x - sim.position[0], heading_y - sim.position[1], head_width=0.5, head_length=0.5, fc='blue', ec='blue')
     
     # Plot trajectory
-    if sim.trajectory:
+    if len(sim.trajectory):
         trajectory_x = [point[0] for point in sim.trajectory]
         trajectory_y = [point[1] for point in sim.trajectory]
         ax.plot(trajectory_x, trajectory_y, 'g--', label='Trajectory')
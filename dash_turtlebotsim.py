@@ -1,19 +1,25 @@
 import time
 import threading
+import queue
 import json
 import os
 import numpy as np
-import paho.mqtt.client as mqtt
 import random
 import plotly.graph_objs as go
-import plotly.express as px
-from plotly.subplots import make_subplots
 import dash
 from dash import dcc, html, Input, Output, State, callback_context
 import dash_bootstrap_components as dbc
 from rpio.clientLibraries.rpclpy.CommunicationManager import CommunicationManager
 import logging
 import redis
+from typing import List, Optional
+
+try:
+    # Optional: validated C decoding of /spin_config messages
+    import msgspec
+    MSGSPEC_AVAILABLE = True
+except ImportError:
+    MSGSPEC_AVAILABLE = False
 
 
 
@@ -24,17 +30,19 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
-# Redis log handler
+# Redis log handler (capped stream: XADD trims to ~maxlen in the same command)
 class RedisLogHandler(logging.Handler):
-    def __init__(self, redis_host='localhost', redis_port=6379, key='Simulator:logs'):
+    def __init__(self, redis_host='localhost', redis_port=6379, key='Simulator:logs:stream', maxlen=1000):
         super().__init__()
         self.redis = redis.StrictRedis(host=os.getenv('REDIS_HOST', 'localhost'), port=int(os.getenv('REDIS_PORT', '6379')), decode_responses=True)
         self.key = key
+        self.maxlen = maxlen
 
     def emit(self, record):
         try:
             msg = self.format(record)
-            self.redis.lpush(self.key, msg)
+            self.redis.xadd(self.key, {"level": record.levelname, "msg": msg},
+                            maxlen=self.maxlen, approximate=True)
         except Exception:
             self.handleError(record)
 
@@ -50,6 +58,40 @@ SCAN_TOPIC = "/Scan"
 SPIN_CONFIG_TOPIC = "/spin_config"
 TRUSTWORTHINESS_TOPIC = "maple"
 
+# Static LaserScan fields; only 'ranges' changes between publishes, so the
+# header is serialized once and the ranges are appended per scan.
+SCAN_HEADER = {
+    'angle_min': -3.124,
+    'angle_max': 3.1415927,
+    'angle_increment': 0.0174533,
+    'scan_time': 0.2,
+    'range_min': 0.1,
+    'range_max': 12.0,
+}
+SCAN_JSON_PREFIX = json.dumps(SCAN_HEADER)[:-1] + ', "ranges": '
+
+if MSGSPEC_AVAILABLE:
+    class SpinPlan(msgspec.Struct):
+        duration: Optional[float] = None
+        omega: float = 90
+
+    class SpinConfig(msgspec.Struct):
+        commands: List[SpinPlan] = []
+
+    _spin_config_decoder = msgspec.json.Decoder(SpinConfig)
+
+# Optional compact scan encoding: 'binary' publishes ranges only, as little-endian
+# uint16 millimetres on SCAN_BIN_TOPIC (0xFFFF = no return); header is SCAN_HEADER.
+SCAN_FORMAT = os.getenv('SCAN_FORMAT', 'json').lower()
+SCAN_BIN_TOPIC = "/Scan/ranges_bin"
+SCAN_BIN_NO_RETURN = 0xFFFF
+
+def encode_ranges_mm(ranges):
+    """Quantize ranges (metres) to a uint16 millimetre byte frame."""
+    arr = np.asarray(ranges, dtype=np.float64)
+    mm = np.where(np.isfinite(arr), np.clip(np.rint(arr * 1000.0), 0, SCAN_BIN_NO_RETURN - 1), SCAN_BIN_NO_RETURN)
+    return mm.astype('<u2').tobytes()
+
 
 # TurtleBotSim class
 class TurtleBotSim:
@@ -61,8 +103,13 @@ class TurtleBotSim:
         self.standard_navigation = True
         self.map_size = 10
         self.obstacles = self.generate_obstacles()
+        # Obstacles are static after init; keep plot-ready coordinate arrays
+        self.obs_x = self.obstacles[:, 0]
+        self.obs_y = self.obstacles[:, 1]
         self.trajectory = []
         self.lidar_data = [random.uniform(5, 10) for _ in range(360)]
+        self.scan_seq = 0  # bumped on every publish_scan so the dashboard can detect new data
+        self.trajectory_seq = 0  # bumped whenever self.trajectory is replaced, for the same reason
         self.navigation_active = False
         self.random_walk_active = False  # NEW: flag for random walk mode
         self.trustworthiness_status = True  # NEW: trustworthiness status from maple topic
@@ -82,18 +129,21 @@ class TurtleBotSim:
         # Random occlusion feature
         self.random_occlusion_active = False
         self.random_occlusion_thread = None
+        # Communication client, attached by initialize_client()
+        self.client = None
+        # Stop event of the latest navigation; stop_navigation() sets it to preempt
+        # waits between waypoints. Each navigation gets a fresh one from arm_navigation().
+        self._stop_evt = threading.Event()
         logging.info("TurtleBotSim initialized with position (0, 0) and angle 1.0")
         
     def generate_obstacles(self, num_obstacles=5):
-        obstacles = []
-        for _ in range(num_obstacles):
-            obstacles.append((random.uniform(-self.map_size, self.map_size), 
-                            random.uniform(-self.map_size, self.map_size)))
-        return obstacles
+        # (num_obstacles, 2) array of x, y positions
+        return np.random.default_rng().uniform(-self.map_size, self.map_size, size=(num_obstacles, 2))
     
     def publish_pose(self):
-        if hasattr(self, 'client') and self.client:
-            client.publish(POSE_TOPIC, json.dumps({
+        c = self.client
+        if c is not None:
+            c.publish(POSE_TOPIC, json.dumps({
                 "x": self.position[0], 
                 "y": self.position[1], 
                 "angle": self.angle
@@ -103,6 +153,7 @@ class TurtleBotSim:
     def publish_scan(self):
         # Start with fresh random data
         self.lidar_data = [random.uniform(5, 10) for _ in range(360)]
+        self.scan_seq += 1
         
         # Apply global occlusion (backward compatibility)
         if self.lidar_occluded:
@@ -121,18 +172,12 @@ class TurtleBotSim:
             self.occlude_angle_range(start_angle, end_angle)
             logging.debug(f"Custom occlusion applied: {start_angle}-{end_angle} degrees")
         
-        lidar_data = {
-            'angle_min': -3.124,
-            'angle_max': 3.1415927,
-            'angle_increment': 0.0174533,
-            'scan_time': 0.2,
-            'range_min': 0.1,
-            'range_max': 12.0,
-            'ranges': self.lidar_data
-        }
-        
-        if hasattr(self, 'client') and self.client:
-            client.publish(SCAN_TOPIC, json.dumps(lidar_data))
+        c = self.client
+        if c is not None:
+            if SCAN_FORMAT == 'binary':
+                c.publish(SCAN_BIN_TOPIC, encode_ranges_mm(self.lidar_data))
+            else:
+                c.publish(SCAN_TOPIC, SCAN_JSON_PREFIX + json.dumps(self.lidar_data) + '}')
 
     def get_sector_range(self, sector):
         """Get angle range for predefined sectors."""
@@ -266,12 +311,24 @@ class TurtleBotSim:
         self.clear_custom_occlusions()
         logging.info("Random occlusion loop ended")
 
-    def navigate_to(self, trajectory):
+    def arm_navigation(self):
+        """Create the stop event for a navigation about to be queued or started.
+
+        Arm before handing the navigation off, so a Stop pressed while it is
+        still pending is not lost.
+        """
+        self._stop_evt = threading.Event()
+        return self._stop_evt
+
+    def navigate_to(self, trajectory, stop_evt):
+        if stop_evt.is_set():  # stopped while still queued
+            return
         self.trajectory = trajectory
+        self.trajectory_seq += 1
         self.navigation_active = True
         logging.info(f"Navigation started with {len(trajectory)} waypoints.")
         for i, point in enumerate(trajectory):
-            if not self.navigation_active:  # Allow stopping navigation
+            if not self.navigation_active or stop_evt.is_set():  # Allow stopping navigation
                 break
             # Use numpy.arctan2 (correct function name) to compute heading
             self.heading = np.arctan2(point[1]-self.position[1], point[0]-self.position[0])
@@ -279,19 +336,23 @@ class TurtleBotSim:
             if self.standard_navigation:
                 self.publish_pose()
                 self.publish_scan()
-                time.sleep(0.5)
+                if stop_evt.wait(0.5):
+                    break
             else:
                 self.publish_pose()
                 self.publish_scan()
-                time.sleep(0.5)
+                if stop_evt.wait(0.5):
+                    break
                 self.heading = self.heading + self.angle
                 self.publish_pose()
                 self.publish_scan()
-                time.sleep(0.5)
+                if stop_evt.wait(0.5):
+                    break
                 self.heading = self.heading - self.angle
                 self.publish_pose()
                 self.publish_scan()
-                time.sleep(0.5)
+                if stop_evt.wait(0.5):
+                    break
         self.navigation_active = False
         logging.info(f"Navigation ended. Final position: {self.position}")
 
@@ -301,20 +362,21 @@ class TurtleBotSim:
         time.sleep(duration)
         logging.info(f"Spin executed: duration={duration}, angle={angle}")
 
-    def random_walk_loop(self):
+    def random_walk_loop(self, stop_evt):
         """Continuously pick random targets and navigate until stopped."""
-        if self.random_walk_active:
-            # already running
+        if self.random_walk_active or stop_evt.is_set():
+            # already running, or stopped before the thread got going
             return
         self.random_walk_active = True
         self.navigation_active = True
         logging.info("Random walk started.")
         try:
-            while self.random_walk_active:
+            while self.random_walk_active and not stop_evt.is_set():
                 target = [random.uniform(-self.map_size, self.map_size),
                           random.uniform(-self.map_size, self.map_size)]
                 trajectory = astar(self.position, target, self.obstacles)
                 self.trajectory = trajectory
+                self.trajectory_seq += 1
                 logging.info(f"Random walk target: ({target[0]:.2f}, {target[1]:.2f}) with {len(trajectory)} waypoints")
                 for point in trajectory:
                     if not self.random_walk_active:
@@ -324,19 +386,23 @@ class TurtleBotSim:
                     if self.standard_navigation:
                         self.publish_pose()
                         self.publish_scan()
-                        time.sleep(0.5)
+                        if stop_evt.wait(0.5):
+                            break
                     else:
                         self.publish_pose()
                         self.publish_scan()
-                        time.sleep(0.5)
+                        if stop_evt.wait(0.5):
+                            break
                         self.heading = self.heading + self.angle
                         self.publish_pose()
                         self.publish_scan()
-                        time.sleep(0.5)
+                        if stop_evt.wait(0.5):
+                            break
                         self.heading = self.heading - self.angle
                         self.publish_pose()
                         self.publish_scan()
-                        time.sleep(0.5)
+                        if stop_evt.wait(0.5):
+                            break
         finally:
             self.navigation_active = False
             self.random_walk_active = False
@@ -345,22 +411,58 @@ class TurtleBotSim:
     def stop_navigation(self):
         self.navigation_active = False
         self.random_walk_active = False  # ensure random walk loop exits
+        self._stop_evt.set()  # wake any navigation thread waiting between waypoints
         # Optional: stop random occlusion when navigation stops
         # self.stop_random_occlusion()
 
 # A* Pathfinding (Simple Implementation)
 def astar(start, end, obstacles):
-    path = []
     steps = 20
-    x_vals = np.linspace(start[0], end[0], steps)
-    y_vals = np.linspace(start[1], end[1], steps)
-    for i in range(steps):
-        path.append([x_vals[i], y_vals[i]])
-    return path
+    return np.stack([np.linspace(start[0], end[0], steps),
+                     np.linspace(start[1], end[1], steps)], axis=1)
 
 # Initialize simulator
 sim = TurtleBotSim()
 
+# Single navigation worker; holds at most one pending trajectory so rapid
+# clicks replace each other instead of spawning racing navigation threads
+_nav_q = queue.Queue(maxsize=1)
+# Serialises stop/drain/arm/enqueue across concurrent Dash callbacks, so the armed
+# stop event always belongs to the navigation that was actually queued or started
+_nav_lock = threading.Lock()
+
+def _navigation_worker():
+    while True:
+        trajectory, stop_evt = _nav_q.get()
+        sim.navigate_to(trajectory, stop_evt)
+
+def request_navigation(target_coords):
+    """Stop the current navigation and queue a trajectory to target_coords."""
+    with _nav_lock:
+        sim.stop_navigation()
+        trajectory = astar(sim.position, target_coords, sim.obstacles)
+        try:
+            _nav_q.get_nowait()  # drop a stale request that hasn't started yet
+        except queue.Empty:
+            pass
+        try:
+            _nav_q.put_nowait((trajectory, sim.arm_navigation()))
+        except queue.Full:
+            logging.warning("Navigation request dropped: another request is pending")
+
+_nav_worker = threading.Thread(target=_navigation_worker, daemon=True)
+_nav_worker.start()
+
+# Obstacle trace never changes, so it is built once and reused by update_plots
+OBSTACLE_TRACE = dict(
+    type='scatter',
+    x=sim.obs_x,
+    y=sim.obs_y,
+    mode='markers',
+    marker=dict(size=12, color='red', symbol='x'),
+    name='Obstacles'
+) if len(sim.obstacles) else None
+
 # Initialize Dash app with Bootstrap theme
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 app.title = "TurtleBot4 Simulation Dashboard"
@@ -600,6 +702,7 @@ app.layout = dbc.Container([
     # Store components for state management
     dcc.Store(id='click-data'),
     dcc.Store(id='navigation-thread'),
+    dcc.Store(id='plot-state'),
     
 ], fluid=True)
 
@@ -614,10 +717,21 @@ app.layout = dbc.Container([
      Output('trustworthiness-status', 'children'),
      Output('trustworthiness-status', 'color'),
      Output('robot-status', 'children'),
-     Output('occlusion-status', 'children')],
-    [Input('interval-component', 'n_intervals')]
+     Output('occlusion-status', 'children'),
+     Output('plot-state', 'data')],
+    [Input('interval-component', 'n_intervals')],
+    [State('plot-state', 'data')]
 )
-def update_plots(n):
+def update_plots(n, last_state):
+    # Skip rebuilding figures when nothing shown on the dashboard has changed
+    occlusion_status = sim.get_occlusion_status()
+    state = [float(sim.position[0]), float(sim.position[1]), float(sim.heading), float(sim.angle),
+             sim.lidar_occluded, sim.standard_navigation, sim.trustworthiness_status,
+             sim.navigation_active, sim.random_walk_active, sim.failure_action,
+             sim.scan_seq, sim.trajectory_seq, occlusion_status]
+    if state == last_state:
+        return (dash.no_update,) * 11
+
     # Create map plot
     map_fig = go.Figure()
     
@@ -644,7 +758,7 @@ def update_plots(n):
     ))
     
     # Add trajectory
-    if sim.trajectory:
+    if len(sim.trajectory):
         traj_x = [point[0] for point in sim.trajectory]
         traj_y = [point[1] for point in sim.trajectory]
         map_fig.add_trace(go.Scatter(
@@ -657,16 +771,8 @@ def update_plots(n):
         ))
     
     # Add obstacles
-    if sim.obstacles:
-        obs_x = [obs[0] for obs in sim.obstacles]
-        obs_y = [obs[1] for obs in sim.obstacles]
-        map_fig.add_trace(go.Scatter(
-            x=obs_x, 
-            y=obs_y,
-            mode='markers',
-            marker=dict(size=12, color='red', symbol='x'),
-            name='Obstacles'
-        ))
+    if OBSTACLE_TRACE is not None:
+        map_fig.add_trace(OBSTACLE_TRACE)
     
     map_fig.update_layout(
         title="TurtleBot4 Map",
@@ -721,10 +827,7 @@ def update_plots(n):
         html.P(f"Obstacles: {len(sim.obstacles)}")
     ])
     
-    # Get current occlusion status
-    occlusion_status = sim.get_occlusion_status()
-    
-    return map_fig, lidar_fig, lidar_status, lidar_color, nav_mode, nav_color, trustworthiness_status, trustworthiness_color, robot_status, occlusion_status
+    return map_fig, lidar_fig, lidar_status, lidar_color, nav_mode, nav_color, trustworthiness_status, trustworthiness_color, robot_status, occlusion_status, state
 
 # Callback for LiDAR toggle
 @app.callback(
@@ -780,13 +883,8 @@ def toggle_trustworthiness(n_clicks):
 )
 def manual_navigate(n_clicks, target_x, target_y):
     if n_clicks and target_x is not None and target_y is not None:
-        target_coords = [target_x, target_y]
-        trajectory = astar(sim.position, target_coords, sim.obstacles)
         logging.info(f"Manual navigation requested to ({target_x}, {target_y})")
-        # Start navigation in a separate thread
-        nav_thread = threading.Thread(target=sim.navigate_to, args=(trajectory,))
-        nav_thread.daemon = True
-        nav_thread.start()
+        request_navigation([target_x, target_y])
         return f"Navigating to ({target_x}, {target_y})"
     return "Navigate to Target"
 
@@ -798,13 +896,8 @@ def manual_navigate(n_clicks, target_x, target_y):
 def handle_map_click(clickData):
     if clickData and 'points' in clickData and len(clickData['points']) > 0:
         point = clickData['points'][0]
-        target_coords = [point['x'], point['y']]
-        trajectory = astar(sim.position, target_coords, sim.obstacles)
         logging.info(f"Map click navigation requested to ({point['x']}, {point['y']})")
-        # Start navigation in a separate thread
-        nav_thread = threading.Thread(target=sim.navigate_to, args=(trajectory,))
-        nav_thread.daemon = True
-        nav_thread.start()
+        request_navigation([point['x'], point['y']])
         return {'x': point['x'], 'y': point['y']}
     return {}
 
@@ -819,13 +912,15 @@ def start_stop_random_walk(n_clicks):
             sim.stop_navigation()
             return "Random Walk (OFF)"
         else:
-            # stop any current navigation and start random walk
-            if sim.navigation_active:
+            # stop any current or queued navigation and start random walk
+            with _nav_lock:
+                was_navigating = sim.navigation_active
                 sim.stop_navigation()
-                time.sleep(0.1)
-            walker_thread = threading.Thread(target=sim.random_walk_loop)
-            walker_thread.daemon = True
-            walker_thread.start()
+                if was_navigating:
+                    time.sleep(0.1)
+                walker_thread = threading.Thread(target=sim.random_walk_loop, args=(sim.arm_navigation(),))
+                walker_thread.daemon = True
+                walker_thread.start()
             return "Random Walk (ON)"
     return "Random Walk (ON)" if sim.random_walk_active else "Random Walk (OFF)"
 
@@ -841,36 +936,57 @@ def update_failure_action(selected_value):
     return selected_value
 
 # MQTT message handlers
+def decode_spin_plan(message):
+    """Return (duration, omega) of the first spin command, or None if there is none.
+
+    Raises ValueError for malformed payloads.
+    """
+    if MSGSPEC_AVAILABLE:
+        try:
+            cfg = _spin_config_decoder.decode(message)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+        if not cfg.commands:
+            return None
+        plan = cfg.commands[0]
+        return plan.duration, plan.omega
+    payload = json.loads(message)
+    if not payload.get("commands"):
+        return None
+    plan = payload.get("commands")[0]
+    return plan.get("duration"), plan.get("omega", 90)
+
 def on_spin_config_message(message):
     try:
-        payload = json.loads(message)
-        if payload.get("commands"):
-            plan = payload.get("commands")[0]
-            duration = plan.get("duration")
-            if duration == 0.0:
-                sim.standard_navigation = True
-            else:
-                # Check trustworthiness status and apply failure action
-                if not sim.trustworthiness_status:
-                    if sim.failure_action == "apply_adaptation":
-                        sim.standard_navigation = False
-                        sim.angle = plan.get("omega", 90)
-                        logging.info(f"Trustworthiness failed - applying adaptation: duration={duration}, omega={plan.get('omega', 90)}")
-                    elif sim.failure_action == "stop_robot":
-                        sim.stop_navigation()
-                        logging.info("Trustworthiness failed - stopping robot")
-                        return
-                    elif sim.failure_action == "continue_standard":
-                        sim.standard_navigation = True
-                        logging.info("Trustworthiness failed - continuing standard navigation")
-                        return
-                else:
-                    sim.standard_navigation = False
-                    sim.angle = plan.get("omega", 90)
-                    logging.info(f"Received spin config: duration={duration}, omega={plan.get('omega', 90)}")
-    except json.JSONDecodeError:
+        spin_plan = decode_spin_plan(message)
+    except ValueError:
         sim.standard_navigation = True
         logging.error("Invalid JSON in spin config message received.")
+        return
+    if spin_plan is None:
+        return
+    duration, omega = spin_plan
+    if duration == 0.0:
+        sim.standard_navigation = True
+    else:
+        # Check trustworthiness status and apply failure action
+        if not sim.trustworthiness_status:
+            if sim.failure_action == "apply_adaptation":
+                sim.standard_navigation = False
+                sim.angle = omega
+                logging.info(f"Trustworthiness failed - applying adaptation: duration={duration}, omega={omega}")
+            elif sim.failure_action == "stop_robot":
+                sim.stop_navigation()
+                logging.info("Trustworthiness failed - stopping robot")
+                return
+            elif sim.failure_action == "continue_standard":
+                sim.standard_navigation = True
+                logging.info("Trustworthiness failed - continuing standard navigation")
+                return
+        else:
+            sim.standard_navigation = False
+            sim.angle = omega
+            logging.info(f"Received spin config: duration={duration}, omega={omega}")
 
 def on_trustworthiness_message(message):
     try:
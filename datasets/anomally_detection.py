@@ -21,10 +21,21 @@ Usage:
 
 import csv
 import math
+import operator
+import multiprocessing
 import argparse
 from collections import deque
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+try:
+    # Optional: compiles the stability kernel; falls back to NumPy without it
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
 # ----------------- Occlusion Detector (from previous message, trimmed where possible) -----------------
 
@@ -37,6 +48,52 @@ class OcclusionSegment:
     width_deg:   float
     stability:   float   # 0..1
 
+_EMPTY_IDX = np.empty(0, dtype=np.int64)
+_EMPTY_STAB = np.empty(0, dtype=np.float64)
+
+def _stability_kernel(s_new, e_new, hist_s, hist_e, hist_offsets, drift_tol, skip_empty):
+    """Stability score per new segment: mean over history of the best drift-penalised Jaccard.
+
+    History is flattened: past scan h owns segments hist_offsets[h]:hist_offsets[h + 1].
+    With skip_empty, past scans without segments are left out of the mean.
+    """
+    n_hist = hist_offsets.size - 1
+    out = np.zeros(s_new.size)
+    n_used = n_hist
+    if skip_empty:
+        n_used = 0
+        for h in range(n_hist):
+            if hist_offsets[h + 1] > hist_offsets[h]:
+                n_used += 1
+    if n_used <= 0:
+        return out
+    for k in range(s_new.size):
+        s0 = s_new[k]
+        e0 = e_new[k]
+        total = 0.0
+        for h in range(n_hist):
+            best = 0.0
+            for p in range(hist_offsets[h], hist_offsets[h + 1]):
+                sp = hist_s[p]
+                ep = hist_e[p]
+                inter = min(e0, ep) - max(s0, sp) + 1
+                if inter < 0:
+                    inter = 0
+                union = (e0 - s0 + 1) + (ep - sp + 1) - inter
+                if union == 0:
+                    continue
+                j = inter / union
+                if abs(sp - s0) > drift_tol or abs(ep - e0) > drift_tol:
+                    j *= 0.5
+                if j > best:
+                    best = j
+            total += best
+        out[k] = total / n_used
+    return out
+
+if NUMBA_AVAILABLE:
+    _stability_kernel = njit(cache=True)(_stability_kernel)
+
 class LidarOcclusionDetector:
     def __init__(
         self,
@@ -47,6 +104,7 @@ class LidarOcclusionDetector:
         persistence_threshold: float = 0.7,
         min_occlusion_width_deg: float = 5.0,
         treat_ge_max_as_inf: bool = True,
+        skip_empty_history: bool = False,
     ):
         self.history_size = history_size
         self.min_segment_beams = min_segment_beams
@@ -55,142 +113,200 @@ class LidarOcclusionDetector:
         self.persistence_threshold = persistence_threshold
         self.min_occlusion_width_deg = min_occlusion_width_deg
         self.treat_ge_max_as_inf = treat_ge_max_as_inf
-
-        self._mask_hist: deque[List[bool]] = deque(maxlen=history_size)
-        self._segs_hist: deque[List[Tuple[int, int]]] = deque(maxlen=history_size)
+        # Leave past scans without segments out of the stability mean (opt-in; a segment
+        # then only needs to match the non-empty scans, which weakens the persistence check)
+        self.skip_empty_history = skip_empty_history
+
+        # Per past scan: (starts, ends) index arrays of its segments
+        self._segs_hist: deque[Tuple[np.ndarray, np.ndarray]] = deque(maxlen=history_size)
+        self._n_beams = 0
+        self._geometry: Optional[Tuple[float, float, int]] = None
+
+        if NUMBA_AVAILABLE:
+            # Trigger JIT compilation (or cache load) before the first scan
+            idx = np.zeros(1, dtype=np.int64)
+            _stability_kernel(idx, idx, idx, idx, np.array([0, 1], dtype=np.int64), self.drift_tol,
+                              self.skip_empty_history)
+
+    def set_geometry(self, angle_min: float, angle_increment: float, n_beams: int) -> None:
+        """Precompute per-beam angles and segment widths for a fixed LiDAR geometry."""
+        self._geometry = (angle_min, angle_increment, n_beams)
+        self._angles = angle_min + np.arange(n_beams) * angle_increment
+        self._angles_deg = np.degrees(self._angles)
+        # Width in degrees of a segment spanning k beams, indexed by k
+        self._widths_deg = np.arange(n_beams + 1) * abs(angle_increment) * 180.0 / math.pi
 
     def add_scan(
         self,
-        ranges: List[float],
+        ranges: Union[np.ndarray, List[float]],
         angle_min: float,
         angle_increment: float,
         range_max: float = 1e9,  # not used if treat_ge_max_as_inf=False
         range_min: float = 0.0
     ) -> Tuple[bool, List[OcclusionSegment]]:
-        n = len(ranges)
-        if n == 0 or angle_increment == 0.0:
+        if len(ranges) == 0 or angle_increment == 0.0:
             return (False, [])
 
-        # 1) Build INF mask
-        mask = [False] * n
-        for i, r in enumerate(ranges):
-            is_inf = math.isinf(r) or math.isnan(r)
-            if not is_inf and self.treat_ge_max_as_inf:
-                if r >= (range_max - 1e-6):
-                    is_inf = True
-            mask[i] = is_inf
+        # 1) Build INF mask (NaN counts as blocked/invalid)
+        arr = np.asarray(ranges, dtype=np.float64)
+        mask = ~np.isfinite(arr)
+        if self.treat_ge_max_as_inf:
+            mask |= arr >= (range_max - 1e-6)
+
+        return self.add_scan_mask(mask, angle_min, angle_increment)
+
+    def add_scan_mask(
+        self,
+        mask: np.ndarray,
+        angle_min: float,
+        angle_increment: float,
+    ) -> Tuple[bool, List[OcclusionSegment]]:
+        """Classify a precomputed blocked-beam mask (True = INF/invalid), skipping range parsing."""
+        starts, ends, stabs = self.classify_mask(mask, angle_min, angle_increment)
+        if starts.size == 0:
+            return (False, [])
+        occluded_segments = [
+            OcclusionSegment(
+                start_idx=s_idx,
+                end_idx=e_idx,
+                start_angle=start_angle,
+                end_angle=end_angle,
+                width_deg=width_deg,
+                stability=stab
+            )
+            for s_idx, e_idx, start_angle, end_angle, width_deg, stab in zip(
+                starts.tolist(), ends.tolist(),
+                self._angles[starts].tolist(), self._angles[ends].tolist(),
+                self._widths_deg[ends - starts + 1].tolist(), stabs.tolist())
+        ]
+        return (True, occluded_segments)
+
+    def classify_mask(
+        self,
+        mask: np.ndarray,
+        angle_min: float,
+        angle_increment: float,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Like add_scan_mask, but return occluded segments as (starts, ends, stabilities) arrays."""
+        n = len(mask)
+        if n == 0 or angle_increment == 0.0:
+            return (_EMPTY_IDX, _EMPTY_IDX, _EMPTY_STAB)
+
+        # Beam indices are only comparable for a fixed geometry
+        if n != self._n_beams:
+            self._segs_hist.clear()
+            self._n_beams = n
+        if self._geometry != (angle_min, angle_increment, n):
+            self.set_geometry(angle_min, angle_increment, n)
 
         # 2) Segments
-        segs = self._find_segments(mask, min_len=self.min_segment_beams, gap=self.gap_merge_beams)
+        starts, ends = self._find_segments(mask, min_len=self.min_segment_beams, gap=self.gap_merge_beams)
 
         # 3) Stability vs history
-        stability_scores = [self._segment_stability(seg) for seg in segs]
-
-        # 4) Convert to angle ranges and filter
-        occluded_segments: List[OcclusionSegment] = []
-        for (seg, stab) in zip(segs, stability_scores):
-            s_idx, e_idx = seg
-            start_angle = angle_min + s_idx * angle_increment
-            end_angle   = angle_min + e_idx   * angle_increment
-            width_deg   = abs(e_idx - s_idx + 1) * abs(angle_increment) * 180.0 / math.pi
-            if width_deg >= self.min_occlusion_width_deg and stab >= self.persistence_threshold:
-                occluded_segments.append(
-                    OcclusionSegment(
-                        start_idx=s_idx,
-                        end_idx=e_idx,
-                        start_angle=start_angle,
-                        end_angle=end_angle,
-                        width_deg=width_deg,
-                        stability=stab
-                    )
-                )
+        if starts.size == 0 or not self._segs_hist:
+            stabs = np.zeros(starts.size)
+        elif NUMBA_AVAILABLE:
+            stabs = self._kernel_stability(starts, ends)
+        else:
+            stabs = np.array([self._segment_stability(seg) for seg in zip(starts.tolist(), ends.tolist())],
+                             dtype=np.float64)
+
+        # 4) Filter by angular width and persistence
+        keep = ((self._widths_deg[ends - starts + 1] >= self.min_occlusion_width_deg)
+                & (stabs >= self.persistence_threshold))
 
         # 5) Update history AFTER classification
-        self._mask_hist.append(mask)
-        self._segs_hist.append(segs)
+        self._segs_hist.append((starts, ends))
 
-        return (len(occluded_segments) > 0, occluded_segments)
+        return (starts[keep], ends[keep], stabs[keep])
 
     # ---- internals ----
-    def _find_segments(self, mask: List[bool], min_len: int, gap: int) -> List[Tuple[int, int]]:
-        n = len(mask)
-        raw: List[Tuple[int, int]] = []
-        i = 0
-        while i < n:
-            if mask[i]:
-                j = i
-                while j + 1 < n and mask[j + 1]:
-                    j += 1
-                raw.append((i, j))
-                i = j + 1
-            else:
-                i += 1
-        if not raw:
-            return []
-
-        merged: List[Tuple[int, int]] = []
-        cur_s, cur_e = raw[0]
-        for s, e in raw[1:]:
-            if s - cur_e - 1 <= gap:
-                cur_e = e
-            else:
-                if (cur_e - cur_s + 1) >= min_len:
-                    merged.append((cur_s, cur_e))
-                cur_s, cur_e = s, e
-        if (cur_e - cur_s + 1) >= min_len:
-            merged.append((cur_s, cur_e))
-        return merged
+    def _find_segments(self, mask: np.ndarray, min_len: int, gap: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Run-length encode the mask: +1 marks a run start, -1 one past its end
+        m = np.asarray(mask, dtype=np.int8)
+        d = np.diff(np.concatenate(([0], m, [0])))
+        starts = np.flatnonzero(d == 1)
+        ends = np.flatnonzero(d == -1) - 1
+        if starts.size == 0:
+            return (_EMPTY_IDX, _EMPTY_IDX)
+
+        # Merge runs separated by at most `gap` clear beams, then drop short ones
+        breaks = np.flatnonzero(starts[1:] - ends[:-1] - 1 > gap)
+        starts = starts[np.concatenate(([0], breaks + 1))]
+        ends = ends[np.concatenate((breaks, [ends.size - 1]))]
+        keep = (ends - starts + 1) >= min_len
+        return (starts[keep], ends[keep])
+
+    def _kernel_stability(self, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        counts = [h[0].size for h in self._segs_hist]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if self._segs_hist:
+            hist_s = np.concatenate([h[0] for h in self._segs_hist])
+            hist_e = np.concatenate([h[1] for h in self._segs_hist])
+        else:
+            hist_s = hist_e = _EMPTY_IDX
+        return _stability_kernel(starts, ends, hist_s, hist_e, offsets, self.drift_tol,
+                                 self.skip_empty_history)
 
     def _segment_stability(self, seg: Tuple[int, int]) -> float:
         if not self._segs_hist:
             return 0.0
         s0, e0 = seg
-        set0 = set(range(s0, e0 + 1))
         overlaps: List[float] = []
-        for past_segs in self._segs_hist:
-            best_j = 0.0
-            for (sp, ep) in past_segs:
-                setp = set(range(sp, ep + 1))
-                inter = len(set0 & setp)
-                union = len(set0 | setp)
-                if union == 0:
-                    continue
-                j = inter / union
-                lb_drift = abs(sp - s0)
-                rb_drift = abs(ep - e0)
-                if lb_drift > self.drift_tol or rb_drift > self.drift_tol:
-                    j *= 0.5
-                if j > best_j:
-                    best_j = j
-            overlaps.append(best_j)
+        for (sp, ep) in self._segs_hist:
+            if sp.size == 0:
+                if not self.skip_empty_history:
+                    overlaps.append(0.0)
+                continue
+            # Segments are contiguous beam ranges, so Jaccard is closed-form
+            inter = np.maximum(0, np.minimum(e0, ep) - np.maximum(s0, sp) + 1)
+            union = (e0 - s0 + 1) + (ep - sp + 1) - inter
+            j = inter / union
+            drifted = (np.abs(sp - s0) > self.drift_tol) | (np.abs(ep - e0) > self.drift_tol)
+            j[drifted] *= 0.5
+            overlaps.append(float(j.max()))
         return sum(overlaps) / len(overlaps) if overlaps else 0.0
 
 # ----------------- CSV I/O wrapper -----------------
 
 def parse_float_maybe_inf(s: str) -> float:
-    s = s.strip().lower()
-    if s in ("inf", "+inf", "infinity", "+infinity"):
-        return float("inf")
-    if s in ("-inf", "-infinity"):
-        return float("-inf")
+    # float() already accepts surrounding whitespace and [+-]inf/infinity/nan in any case
     try:
         return float(s)
     except ValueError:
         # Treat unknown tokens as NaN -> considered INF in detector (blocked/invalid)
         return float("nan")
 
+def load_ranges_matrix(rows: List[List[str]], indices: List[int]) -> np.ndarray:
+    """Parse the given columns of all rows into a (T, N) float64 matrix."""
+    if not rows:
+        return np.empty((0, len(indices)), dtype=np.float64)
+    # Pick the lidar cells out of each row up front so other columns are never converted
+    if len(indices) == 1:
+        cells = [(row[indices[0]],) for row in rows]
+    else:
+        get = operator.itemgetter(*indices)
+        cells = [get(row) for row in rows]
+    try:
+        # float() semantics per cell: accepts inf/-inf/infinity/nan case-insensitively
+        return np.array(cells, dtype=np.float64)
+    except ValueError:
+        # Unknown tokens present: fall back to per-cell parsing (unknown -> NaN)
+        return np.vectorize(parse_float_maybe_inf, otypes=[np.float64])(np.array(cells, dtype=object))
+
+def _format_angle_ranges(start_deg: np.ndarray, end_deg: np.ndarray) -> str:
+    # ensure consistent ordering left->right
+    lo = np.minimum(start_deg, end_deg).tolist()
+    hi = np.maximum(start_deg, end_deg).tolist()
+    return "; ".join(f"{a_lo:.1f}–{a_hi:.1f}" for a_lo, a_hi in zip(lo, hi))
+
 def format_ranges_deg(segs: List[OcclusionSegment]) -> str:
     """Format angle ranges in degrees like: '-30.0–-12.0; 145.0–170.0' """
     if not segs:
         return ""
-    parts = []
-    for s in segs:
-        a0 = math.degrees(s.start_angle)
-        a1 = math.degrees(s.end_angle)
-        # ensure consistent ordering left->right
-        a_lo, a_hi = (a0, a1) if a0 <= a1 else (a1, a0)
-        parts.append(f"{a_lo:.1f}–{a_hi:.1f}")
-    return "; ".join(parts)
+    return _format_angle_ranges(np.degrees([s.start_angle for s in segs]),
+                                np.degrees([s.end_angle for s in segs]))
 
 def detect_lidar_columns(header: List[str]) -> List[Tuple[int, str]]:
     cols = []
@@ -206,6 +322,48 @@ def detect_lidar_columns(header: List[str]) -> List[Tuple[int, str]]:
     cols.sort(key=lambda t: idx_of(t[1]))
     return cols
 
+# Below this many rows per worker, process start-up outweighs the parallel gain
+MIN_ROWS_PER_WORKER = 200
+
+# Characters that make csv.writer quote a field
+_CSV_SPECIAL = ',"\r\n'
+
+
+def _detect_rows(
+    detector_kwargs: dict,
+    blocked: np.ndarray,
+    timesteps: List[str],
+    angle_min: float,
+    angle_inc: float,
+    skip: int = 0
+) -> List[Tuple]:
+    """Run a fresh detector over consecutive mask rows and format the output rows.
+
+    The first `skip` rows only warm up the detector history and are not emitted.
+    """
+    detector = LidarOcclusionDetector(**detector_kwargs)
+    detector.set_geometry(angle_min, angle_inc, blocked.shape[1])
+    out_rows = []
+    angles_deg = detector._angles_deg
+    for t in range(blocked.shape[0]):
+        starts, ends, stabs = detector.classify_mask(blocked[t], angle_min, angle_inc)
+        if t < skip:
+            continue
+
+        k = starts.size
+        if k:
+            ranges_str = _format_angle_ranges(angles_deg[starts], angles_deg[ends])
+            idx_str = "; ".join(f"{s}-{e}" for s, e in zip(starts.tolist(), ends.tolist()))
+            stab_str = "; ".join(f"{v:.2f}" for v in stabs.tolist())
+        else:
+            ranges_str = idx_str = stab_str = ""
+
+        out_rows.append((timesteps[t], int(k > 0), k, ranges_str, idx_str, stab_str))
+    return out_rows
+
+def _detect_rows_star(args: tuple) -> List[Tuple]:
+    return _detect_rows(*args)
+
 def run(
     input_csv: str,
     output_csv: str,
@@ -217,19 +375,23 @@ def run(
     min_occlusion_width_deg: float = 5.0,
     angle_min_deg: float = -180.0,
     angle_span_deg: float = 360.0,
-    treat_ge_max_as_inf: bool = False  # for CSV, we usually rely on explicit 'inf'
+    treat_ge_max_as_inf: bool = False,  # for CSV, we usually rely on explicit 'inf'
+    skip_empty_history: bool = False,
+    verbose: bool = False,
+    workers: int = 1
 ):
-    detector = LidarOcclusionDetector(
+    detector_kwargs = dict(
         history_size=history_size,
         min_segment_beams=min_segment_beams,
         gap_merge_beams=gap_merge_beams,
         drift_tolerance_beams=drift_tolerance_beams,
         persistence_threshold=persistence_threshold,
         min_occlusion_width_deg=min_occlusion_width_deg,
-        treat_ge_max_as_inf=treat_ge_max_as_inf
+        treat_ge_max_as_inf=treat_ge_max_as_inf,
+        skip_empty_history=skip_empty_history
     )
 
-    with open(input_csv, "r", newline="") as f_in, open(output_csv, "w", newline="") as f_out:
+    with open(input_csv, "r", newline="") as f_in, open(output_csv, "w", newline="", buffering=1 << 20) as f_out:
         reader = csv.reader(f_in)
         header = next(reader)
         lidar_cols = detect_lidar_columns(header)
@@ -253,27 +415,42 @@ def run(
         ]
         writer.writerow(out_header)
 
-        for row in reader:
-            # timestep (string is OK, often an int/float)
-            print(f"Row length={len(row)} expected={len(header)}")
-            timestep = row[0]
-
-            # build ranges array in lidar_0..lidar_N order
-            ranges = [parse_float_maybe_inf(row[i]) for (i, _) in lidar_cols]
-
-            is_occ, segs = detector.add_scan(
-                ranges=ranges,
-                angle_min=angle_min,
-                angle_increment=angle_inc,
-                range_max=1e9,
-                range_min=0.0,
-            )
-
-            ranges_str = format_ranges_deg(segs)
-            idx_str = "; ".join(f"{s.start_idx}-{s.end_idx}" for s in segs) if segs else ""
-            stab_str = "; ".join(f"{s.stability:.2f}" for s in segs) if segs else ""
-
-            writer.writerow([timestep, int(is_occ), len(segs), ranges_str, idx_str, stab_str])
+        # Load all scans at once as a (T, N) matrix in lidar_0..lidar_N order
+        rows = list(reader)
+        ranges = load_ranges_matrix(rows, [i for (i, _) in lidar_cols])
+        blocked = ~np.isfinite(ranges)
+        if treat_ge_max_as_inf:
+            blocked |= ranges >= (1e9 - 1e-6)
+
+        # timestep (string is OK, often an int/float)
+        timesteps = [row[0] for row in rows]
+        if verbose:
+            for row in rows:
+                print(f"Row length={len(row)} expected={len(header)}")
+
+        n_rows = len(rows)
+        workers = max(1, min(workers, n_rows // MIN_ROWS_PER_WORKER))
+        if workers == 1:
+            out_rows = _detect_rows(detector_kwargs, blocked, timesteps, angle_min, angle_inc)
+        else:
+            # Each chunk is preceded by `history_size` overlap rows so its detector
+            # reaches the chunk start with the same history as a serial pass.
+            bounds = np.linspace(0, n_rows, workers + 1).astype(int)
+            tasks = []
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                lo = max(0, start - history_size)
+                tasks.append((detector_kwargs, blocked[lo:end], timesteps[lo:end],
+                              angle_min, angle_inc, start - lo))
+            with multiprocessing.Pool(workers) as pool:
+                chunks = pool.map(_detect_rows_star, tasks)
+            out_rows = [r for chunk in chunks for r in chunk]
+
+        # Generated fields never contain commas or quotes ("; "-joined), so
+        # rows can be written preformatted unless a timestep needs quoting.
+        if any(c in ts for ts in timesteps for c in _CSV_SPECIAL):
+            writer.writerows(out_rows)
+        else:
+            f_out.write("".join(f"{ts},{occ},{k},{r},{i},{st}\r\n" for ts, occ, k, r, i, st in out_rows))
 
 # ----------------- CLI -----------------
 
@@ -293,6 +470,12 @@ def main():
                    help="Total angular span covered by the lidar_* columns in degrees.")
     p.add_argument("--treat-ge-max-as-inf", action="store_true",
                    help="Also treat values >= range_max as INF (usually unnecessary for CSV).")
+    p.add_argument("--skip-empty-history", action="store_true",
+                   help="Leave past scans without segments out of the stability average.")
+    p.add_argument("--workers", type=int, default=1,
+                   help="Worker processes for large inputs (default: 1 = serial).")
+    p.add_argument("--verbose", action="store_true",
+                   help="Print per-row diagnostics while processing.")
     args = p.parse_args()
 
     run(
@@ -307,6 +490,9 @@ def main():
         angle_min_deg=args.angle_min_deg,
         angle_span_deg=args.angle_span_deg,
         treat_ge_max_as_inf=args.treat_ge_max_as_inf,
+        skip_empty_history=args.skip_empty_history,
+        verbose=args.verbose,
+        workers=args.workers,
     )
 
 if __name__ == "__main__":
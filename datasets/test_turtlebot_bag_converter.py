@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Tests for turtlebot_bag_converter.py (run: python -m unittest test_turtlebot_bag_converter)."""
+
+import math
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import turtlebot_bag_converter as conv
+
+
+class OrderedScanFastPathTest(unittest.TestCase):
+    """The in-order shortcut must match the wrap-and-sort path exactly."""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.converter = conv.TurtleBotLidarBagConverter()
+        # RPLIDAR-style geometry: 360 beams from 0 rad at ~1 degree (float32 increment)
+        self.angle_min = 0.0
+        self.angle_increment = float(np.float32(math.radians(1.0)))
+        self.scans = []
+        for _ in range(8):
+            ranges = rng.uniform(0.2, 9.0, 360)
+            ranges[rng.random(360) < 0.15] = np.inf
+            ranges[rng.random(360) < 0.05] = np.nan
+            ranges[rng.random(360) < 0.05] = 0.0
+            self.scans.append((ranges, self.angle_min, 2 * math.pi, self.angle_increment))
+
+    def _check_against_slow_path(self):
+        self.assertTrue(conv._angles_in_order(360, np.degrees(self.angle_min),
+                                              np.degrees(self.angle_increment)))
+        fast = [self.converter.interpolate_to_360_points(*scan) for scan in self.scans]
+        fast_batch = self.converter.interpolate_scans(self.scans)
+        with mock.patch.object(conv, '_angles_in_order', return_value=False):
+            slow = [self.converter.interpolate_to_360_points(*scan) for scan in self.scans]
+            slow_batch = self.converter.interpolate_scans(self.scans)
+        np.testing.assert_array_equal(np.array(fast), np.array(slow))
+        np.testing.assert_array_equal(fast_batch, slow_batch)
+        np.testing.assert_array_equal(fast_batch, np.array(slow))
+        # Invalid beams are interpolated from their neighbours, not left as inf
+        self.assertLess(np.isinf(fast_batch).sum(), np.isinf([s[0] for s in self.scans]).sum())
+
+    def test_numpy_path(self):
+        with mock.patch.object(conv, 'NUMBA_AVAILABLE', False):
+            self._check_against_slow_path()
+
+    @unittest.skipUnless(conv.NUMBA_AVAILABLE, "numba not installed")
+    def test_numba_path(self):
+        self._check_against_slow_path()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,8 +14,10 @@ Date: September 2025
 
 import os
 import sys
-import csv
+import queue
+import threading
 import sqlite3
+import struct
 import numpy as np
 from typing import List, Dict, Any, Optional
 import logging
@@ -45,6 +47,95 @@ except ImportError as e:
     ROS1_AVAILABLE = False
     logger.warning(f"ROS 1 libraries not available: {e}")
 
+try:
+    # Optional: compiles the per-scan interpolation kernel; falls back to NumPy without it
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+def _interp360(ranges, angle_min_deg, angle_increment_deg):
+    """
+    Single-pass equivalent of the NumPy path in interpolate_to_360_points.
+    
+    Returns the 360 interpolated ranges and the number of valid input ranges.
+    """
+    n = ranges.size
+    angles = np.empty(n)
+    values = np.empty(n)
+    m = 0
+    for i in range(n):
+        r = ranges[i]
+        if np.isfinite(r) and r > 0:
+            angles[m] = (i * angle_increment_deg + angle_min_deg) % 360
+            values[m] = r
+            m += 1
+    
+    out = np.full(360, np.inf)
+    if m == 1:
+        out[:] = values[0]
+    elif m > 1:
+        order = np.argsort(angles[:m])
+        xp = angles[:m][order]
+        fp = values[:m][order]
+        out = np.interp(np.arange(360.0), xp, fp)
+        # Outside the measured span: inf (np.interp's left/right are not available under numba)
+        for k in range(360):
+            if k < xp[0] or k > xp[m - 1]:
+                out[k] = np.inf
+    return out, m
+
+def _interp360_batch(raw, angle_min_deg, angle_increment_deg):
+    """_interp360 over every row of a (N, beams) array of scans sharing one geometry."""
+    out = np.empty((raw.shape[0], 360))
+    n_valid = np.empty(raw.shape[0], dtype=np.int64)
+    for i in prange(raw.shape[0]):
+        out[i], n_valid[i] = _interp360(raw[i], angle_min_deg, angle_increment_deg)
+    return out, n_valid
+
+if NUMBA_AVAILABLE:
+    # Explicit signatures compile eagerly at import; cache=True stores the machine code
+    # in __pycache__, so only the first run pays the compile cost
+    _interp360 = njit('Tuple((float64[:], int64))(float64[:], float64, float64)',
+                      cache=True)(_interp360)
+    _interp360_batch = njit('Tuple((float64[:, :], int64[:]))(float64[:, :], float64, float64)',
+                            parallel=True, cache=True)(_interp360_batch)
+
+def _angles_in_order(n_ranges: int, angle_min_deg: float, angle_increment_deg: float) -> bool:
+    """
+    True if the beam angles already increase within [0, 360) degrees (e.g. RPLIDAR A1),
+    so wrapping them to 0-360 and sorting would leave them unchanged.
+    """
+    return (angle_increment_deg > 0 and angle_min_deg >= 0
+            and (n_ranges - 1) * angle_increment_deg + angle_min_deg < 360)
+
+def _parse_laserscan_cdr(data: bytes):
+    """
+    Decode a CDR-serialized sensor_msgs/msg/LaserScan without ROS libraries.
+    
+    Returns (ranges, angle_min, angle_max, angle_increment) like the message fields.
+    """
+    # 4-byte encapsulation header; second byte 0x01 = little endian
+    endian = '<' if data[1] == 1 else '>'
+    # header.stamp (sec, nanosec), then header.frame_id as length-prefixed string
+    (frame_id_len,) = struct.unpack_from(endian + 'I', data, 12)
+    pos = 16 + frame_id_len
+    # CDR aligns the following float32 fields to 4 bytes (offsets exclude the encapsulation header)
+    pos = 4 + ((pos - 4 + 3) & ~3)
+    (angle_min, angle_max, angle_increment,
+     time_increment, scan_time, range_min, range_max) = struct.unpack_from(endian + '7f', data, pos)
+    pos += 28
+    (n_ranges,) = struct.unpack_from(endian + 'I', data, pos)
+    ranges = np.frombuffer(data, dtype=endian + 'f4', count=n_ranges, offset=pos + 4)
+    return ranges, angle_min, angle_max, angle_increment
+
+# Raw scans staged before each batched interpolation call
+SCAN_BATCH_SIZE = 1024
+
+# One output row: timestep and 360 ranges; '%.5f' prints inf as 'inf'
+CSV_ROW_FORMAT = '%d,' + ','.join(['%.5f'] * 360) + '\r\n'
+
 class TurtleBotLidarBagConverter:
     """Convert LiDAR data from ROS bags to TurtleBot simulator CSV format."""
     
@@ -70,7 +161,7 @@ class TurtleBotLidarBagConverter:
             return 'unknown'
     
     def interpolate_to_360_points(self, ranges: List[float], angle_min: float, 
-                                angle_max: float, angle_increment: float) -> List[float]:
+                                angle_max: float, angle_increment: float) -> np.ndarray:
         """
         Interpolate LiDAR data to exactly 360 points (0-359 degrees).
         
@@ -81,59 +172,99 @@ class TurtleBotLidarBagConverter:
             angle_increment: Angle increment in radians
             
         Returns:
-            List of 360 range values corresponding to 0-359 degrees
+            Array of 360 range values corresponding to 0-359 degrees
         """
-        if not ranges:
-            return [float('inf')] * 360
+        ranges = np.asarray(ranges, dtype=np.float64)
+        if ranges.size == 0:
+            return np.full(360, np.inf)
         
         # Convert angles to degrees
         angle_min_deg = np.degrees(angle_min)
-        angle_max_deg = np.degrees(angle_max)
         angle_increment_deg = np.degrees(angle_increment)
         
-        # Create input angle array
-        input_angles = np.arange(angle_min_deg, angle_min_deg + len(ranges) * angle_increment_deg, angle_increment_deg)
+        # Ordered scans skip the wrap and sort, which leaves NumPy faster than the numba kernel
+        in_order = _angles_in_order(ranges.size, angle_min_deg, angle_increment_deg)
+        
+        if NUMBA_AVAILABLE and not in_order:
+            interpolated_ranges, n_valid = _interp360(ranges, angle_min_deg, angle_increment_deg)
+            if n_valid == 0:
+                logger.warning("No valid range measurements found")
+            return interpolated_ranges
         
-        # Target angles: 0, 1, 2, ..., 359 degrees
-        target_angles = np.arange(0, 360)
+        # Create input angle array (one angle per range, no float-step arange drift)
+        input_angles = np.arange(ranges.size, dtype=np.float64) * angle_increment_deg + angle_min_deg
         
-        # Clean up ranges (handle inf and nan values)
-        clean_ranges = []
-        clean_angles = []
-        for i, r in enumerate(ranges):
-            if i < len(input_angles):
-                if np.isfinite(r) and r > 0:
-                    clean_ranges.append(r)
-                    clean_angles.append(input_angles[i])
+        # Clean up ranges (drop inf, nan and non-positive values)
+        valid = np.isfinite(ranges) & (ranges > 0)
+        clean_ranges = ranges[valid]
         
-        if len(clean_ranges) == 0:
+        if clean_ranges.size == 0:
             logger.warning("No valid range measurements found")
-            return [float('inf')] * 360
+            return np.full(360, np.inf)
         
-        clean_ranges = np.array(clean_ranges)
-        clean_angles = np.array(clean_angles)
+        if clean_ranges.size == 1:
+            return np.full(360, clean_ranges[0])
         
-        # Normalize angles to 0-360 range
-        clean_angles = clean_angles % 360
+        clean_angles = input_angles[valid]
+        if not in_order:
+            # Normalize angles to 0-360 range and sort by angle
+            clean_angles = clean_angles % 360
+            sort_idx = np.argsort(clean_angles)
+            clean_angles = clean_angles[sort_idx]
+            clean_ranges = clean_ranges[sort_idx]
         
-        # Sort by angle
-        sort_idx = np.argsort(clean_angles)
-        clean_angles = clean_angles[sort_idx]
-        clean_ranges = clean_ranges[sort_idx]
+        # Interpolate to target angles: 0, 1, 2, ..., 359 degrees
+        return np.interp(np.arange(360.0), clean_angles, clean_ranges,
+                         left=np.inf, right=np.inf)
+    
+    def interpolate_scans(self, scans: List[tuple]) -> np.ndarray:
+        """
+        Interpolate a sequence of raw scans to a (len(scans), 360) array.
+        
+        Args:
+            scans: (ranges, angle_min, angle_max, angle_increment) tuples, as passed
+                to interpolate_to_360_points
         
-        # Interpolate to target angles
-        interpolated_ranges = []
-        for target_angle in target_angles:
-            # Find closest measurements
-            if len(clean_angles) == 1:
-                interpolated_ranges.append(clean_ranges[0])
+        Runs of consecutive scans with the same geometry are interpolated in one
+        parallel numba call when numba is available.
+        """
+        out = np.empty((len(scans), 360))
+        start = 0
+        while start < len(scans):
+            ranges, angle_min, angle_max, angle_increment = scans[start]
+            geometry = (len(ranges), angle_min, angle_increment)
+            end = start + 1
+            while end < len(scans) and (len(scans[end][0]), scans[end][1], scans[end][3]) == geometry:
+                end += 1
+            
+            angle_min_deg = np.degrees(angle_min)
+            angle_increment_deg = np.degrees(angle_increment)
+            if (NUMBA_AVAILABLE and end - start > 1 and len(ranges) > 0
+                    and not _angles_in_order(len(ranges), angle_min_deg, angle_increment_deg)):
+                raw = np.array([scan[0] for scan in scans[start:end]], dtype=np.float64)
+                out[start:end], n_valid = _interp360_batch(raw, angle_min_deg, angle_increment_deg)
+                for _ in range(np.count_nonzero(n_valid == 0)):
+                    logger.warning("No valid range measurements found")
             else:
-                # Use linear interpolation
-                interp_value = np.interp(target_angle, clean_angles, clean_ranges, 
-                                       left=float('inf'), right=float('inf'))
-                interpolated_ranges.append(interp_value)
+                for i in range(start, end):
+                    out[i] = self.interpolate_to_360_points(*scans[i])
+            start = end
+        return out
+    
+    def _flush_scans(self, pending: List[tuple], csvfile, output_path: str, count: int):
+        """
+        Interpolate pending raw scans and append them to the output CSV.
         
-        return interpolated_ranges
+        The CSV is created on the first non-empty flush; returns (csvfile, count).
+        """
+        if not pending:
+            return csvfile, count
+        block = self.interpolate_scans(pending)
+        pending.clear()
+        if csvfile is None:
+            csvfile = self._open_turtlebot_csv(output_path)
+        self._write_scan_rows(csvfile, block, count)
+        return csvfile, count + len(block)
     
     def convert_ros1_bag(self, bag_path: str, output_csv: str, topic_filter: Optional[List[str]] = None) -> bool:
         """Convert ROS 1 bag file to TurtleBot CSV format."""
@@ -141,6 +272,7 @@ class TurtleBotLidarBagConverter:
             logger.error("ROS 1 libraries not available")
             return False
         
+        csvfile = None
         try:
             with rosbag.Bag(bag_path, 'r') as bag:
                 info = bag.get_info()
@@ -161,22 +293,66 @@ class TurtleBotLidarBagConverter:
                     logger.warning("No LaserScan topics found in bag file")
                     return False
                 
-                # Extract and convert data
-                scan_data = []
+                # Extract and convert data, streaming each batch of rows to the CSV
+                count = 0
+                pending = []
+                # lidar_topics only holds LaserScan topics, so every message has ranges
                 for topic, msg, timestamp in bag.read_messages(topics=lidar_topics):
-                    if hasattr(msg, 'ranges'):
-                        interpolated_ranges = self.interpolate_to_360_points(
-                            msg.ranges, msg.angle_min, msg.angle_max, msg.angle_increment)
-                        scan_data.append(interpolated_ranges)
+                    pending.append((msg.ranges, msg.angle_min, msg.angle_max, msg.angle_increment))
+                    if len(pending) == SCAN_BATCH_SIZE:
+                        csvfile, count = self._flush_scans(pending, csvfile, output_csv, count)
+                csvfile, count = self._flush_scans(pending, csvfile, output_csv, count)
                 
-                # Write to CSV in TurtleBot format
-                self._write_turtlebot_csv(scan_data, output_csv)
-                logger.info(f"Successfully converted {len(scan_data)} scans to {output_csv}")
+                self._log_csv_written(csvfile, count)
+                logger.info(f"Successfully converted {count} scans to {output_csv}")
                 return True
                 
         except Exception as e:
             logger.error(f"Error processing ROS 1 bag: {e}")
             return False
+        finally:
+            if csvfile is not None:
+                csvfile.close()
+    
+    def _read_ahead(self, reader, maxsize: int = 64):
+        """
+        Yield (topic, data, timestamp) from a ROS 2 SequentialReader.
+        
+        Messages are read on a background thread into a bounded queue, so bag I/O
+        overlaps with deserialization and interpolation in the caller.
+        """
+        messages = queue.Queue(maxsize=maxsize)
+        stop = threading.Event()
+        
+        def put(item):
+            while not stop.is_set():
+                try:
+                    messages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+        
+        def produce():
+            try:
+                while not stop.is_set() and reader.has_next():
+                    put(reader.read_next())
+                put(None)
+            except Exception as e:
+                put(e)
+        
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = messages.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
     
     def convert_ros2_bag(self, bag_path: str, output_csv: str, topic_filter: Optional[List[str]] = None) -> bool:
         """Convert ROS 2 bag file to TurtleBot CSV format."""
@@ -184,6 +360,7 @@ class TurtleBotLidarBagConverter:
             logger.error("ROS 2 libraries not available")
             return False
         
+        csvfile = None
         try:
             rclpy.init()
             
@@ -214,29 +391,29 @@ class TurtleBotLidarBagConverter:
                 logger.warning("No LaserScan topics found in bag file")
                 return False
             
-            # Extract data
-            scan_data = []
-            while reader.has_next():
-                (topic, data, timestamp) = reader.read_next()
+            # Extract data, streaming each batch of rows to the CSV
+            count = 0
+            pending = []
+            lidar_topic_names = frozenset(t[0] for t in lidar_topics)
+            for (topic, data, timestamp) in self._read_ahead(reader):
                 
-                # Check if this topic is in our LiDAR topics
-                topic_info = next((t for t in lidar_topics if t[0] == topic), None)
-                if topic_info:
-                    try:
-                        from sensor_msgs.msg import LaserScan
-                        msg = deserialize_message(data, LaserScan)
-                        
-                        interpolated_ranges = self.interpolate_to_360_points(
-                            msg.ranges, msg.angle_min, msg.angle_max, msg.angle_increment)
-                        scan_data.append(interpolated_ranges)
-                        
-                    except Exception as e:
-                        logger.warning(f"Error deserializing message: {e}")
-                        continue
+                # Skip anything that is not one of our LiDAR topics
+                if topic not in lidar_topic_names:
+                    continue
+                try:
+                    msg = deserialize_message(data, LaserScan)
+                    
+                    pending.append((msg.ranges, msg.angle_min, msg.angle_max, msg.angle_increment))
+                    
+                except Exception as e:
+                    logger.warning(f"Error deserializing message: {e}")
+                    continue
+                if len(pending) == SCAN_BATCH_SIZE:
+                    csvfile, count = self._flush_scans(pending, csvfile, output_csv, count)
+            csvfile, count = self._flush_scans(pending, csvfile, output_csv, count)
             
-            # Write to CSV in TurtleBot format
-            self._write_turtlebot_csv(scan_data, output_csv)
-            logger.info(f"Successfully converted {len(scan_data)} scans to {output_csv}")
+            self._log_csv_written(csvfile, count)
+            logger.info(f"Successfully converted {count} scans to {output_csv}")
             
             rclpy.shutdown()
             return True
@@ -246,12 +423,19 @@ class TurtleBotLidarBagConverter:
             if rclpy.ok():
                 rclpy.shutdown()
             return False
+        finally:
+            if csvfile is not None:
+                csvfile.close()
     
-    def convert_simple_db3(self, bag_path: str, output_csv: str) -> bool:
+    def convert_simple_db3(self, bag_path: str, output_csv: str, topic_filter: Optional[List[str]] = None) -> bool:
         """
         Simple conversion from .db3 file without full ROS dependencies.
         This is a fallback method that provides basic functionality.
+        
+        LaserScan messages are decoded straight from their CDR blobs; bags without
+        LaserScan topics fall back to simulated data.
         """
+        csvfile = None
         try:
             if os.path.isdir(bag_path):
                 # Find .db3 files in directory
@@ -269,26 +453,61 @@ class TurtleBotLidarBagConverter:
             conn = sqlite3.connect(db3_path)
             cursor = conn.cursor()
             
-            # Get messages count
-            cursor.execute("SELECT COUNT(*) FROM messages;")
-            message_count = cursor.fetchone()[0]
+            # Get messages count (rosbag2 never deletes rows, so the largest rowid is the
+            # count, read from the index instead of scanning the whole table)
+            cursor.execute("SELECT MAX(rowid) FROM messages;")
+            message_count = cursor.fetchone()[0] or 0
             logger.info(f"Found {message_count} messages in bag file")
             
+            # Find LiDAR topics
+            lidar_topic_ids = []
+            try:
+                cursor.execute("SELECT id, name, type FROM topics;")
+                topics = cursor.fetchall()
+            except sqlite3.OperationalError:
+                topics = []
+            for topic_id, topic_name, topic_type in topics:
+                if ('LaserScan' in topic_type and
+                    ((topic_filter and topic_name in topic_filter) or
+                     (not topic_filter and any(supported in topic_name for supported in self.supported_topics)))):
+                    lidar_topic_ids.append(topic_id)
+                    logger.info(f"Found LiDAR topic: {topic_name} ({topic_type})")
+            
+            if lidar_topic_ids:
+                # Decode the LaserScan messages, streaming each batch of rows to the CSV
+                count = 0
+                pending = []
+                cursor.execute(
+                    f"SELECT data FROM messages WHERE topic_id IN ({','.join('?' * len(lidar_topic_ids))}) "
+                    "ORDER BY timestamp;", lidar_topic_ids)
+                for (data,) in cursor:
+                    try:
+                        pending.append(_parse_laserscan_cdr(data))
+                    except (struct.error, ValueError, IndexError) as e:
+                        logger.warning(f"Error decoding LaserScan message: {e}")
+                        continue
+                    if len(pending) == SCAN_BATCH_SIZE:
+                        csvfile, count = self._flush_scans(pending, csvfile, output_csv, count)
+                csvfile, count = self._flush_scans(pending, csvfile, output_csv, count)
+                
+                self._log_csv_written(csvfile, count)
+                logger.info(f"Successfully converted {count} scans to {output_csv}")
+                conn.close()
+                return True
+            
             # For simple conversion, create simulated 360-degree LiDAR data
-            # This is a fallback when we can't parse the actual LaserScan messages
-            scan_data = []
-            for i in range(min(message_count, 1000)):  # Limit to 1000 scans for safety
+            # This is a fallback when the bag has no LaserScan messages to parse
+            scan_data = np.empty((min(message_count, 1000), 360))  # Limit to 1000 scans for safety
+            # Angle-dependent variation is the same for every scan
+            angle_term = 0.3 * np.sin(np.radians(np.arange(360) * 3))
+            for i in range(len(scan_data)):
                 # Create simulated data with some variation
                 base_range = 2.0 + 0.5 * np.sin(i * 0.1)  # Varying base distance
-                ranges = []
-                for angle in range(360):
-                    # Add some realistic variation
-                    range_val = base_range + 0.3 * np.sin(np.radians(angle * 3)) + 0.1 * np.random.random()
-                    ranges.append(max(0.1, range_val))  # Ensure positive values
-                scan_data.append(ranges)
+                # Add some realistic variation, ensuring positive values
+                scan_data[i] = np.maximum(0.1, base_range + angle_term + 0.1 * np.random.random(360))
             
             self._write_turtlebot_csv(scan_data, output_csv)
-            logger.warning(f"Generated {len(scan_data)} simulated scans (raw bag parsing not available)")
+            logger.warning(f"Generated {len(scan_data)} simulated scans (no LaserScan topics found)")
             
             conn.close()
             return True
@@ -296,47 +515,52 @@ class TurtleBotLidarBagConverter:
         except Exception as e:
             logger.error(f"Error in simple conversion: {e}")
             return False
+        finally:
+            if csvfile is not None:
+                csvfile.close()
     
-    def _write_turtlebot_csv(self, scan_data: List[List[float]], output_path: str):
+    def _write_turtlebot_csv(self, scan_data: np.ndarray, output_path: str):
         """
         Write scan data to CSV in TurtleBot simulator format.
         
         Format: timestep,lidar_0,lidar_1,...,lidar_359
         """
-        if not scan_data:
+        if len(scan_data) == 0:
             logger.warning("No scan data to write")
             return
         
-        # Create header
+        with self._open_turtlebot_csv(output_path) as csvfile:
+            self._write_scan_rows(csvfile, scan_data, 0)
+        
+        self._log_csv_written(csvfile, len(scan_data))
+    
+    def _log_csv_written(self, csvfile, count: int):
+        """Report the CSV written by a conversion (csvfile is None if no scans were found)."""
+        if csvfile is None:
+            logger.warning("No scan data to write")
+        else:
+            logger.info(f"CSV written with {count} scans and 361 columns (timestep + 360 lidar points)")
+    
+    def _open_turtlebot_csv(self, output_path: str):
+        """Create the output CSV and write its header row."""
         header = ['timestep'] + [f'lidar_{i}' for i in range(360)]
+        csvfile = open(output_path, 'w', newline='', buffering=1 << 20)
+        # Rows end in \r\n like csv.writer output
+        csvfile.write(','.join(header) + '\r\n')
+        return csvfile
+    
+    def _write_scan_rows(self, csvfile, scan_data: np.ndarray, first_timestep: int):
+        """Append scans to an open CSV, numbering them from first_timestep."""
+        scan_data = np.asarray(scan_data, dtype=np.float64)
+        # Every producer interpolates to exactly 360 points
+        if scan_data.ndim != 2 or scan_data.shape[1] != 360:
+            raise ValueError(f"Scans have {scan_data.shape[-1]} points, expected 360")
         
-        with open(output_path, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(header)
-            
-            # Write each scan with timestep
-            for timestep, ranges in enumerate(scan_data):
-                # Ensure we have exactly 360 values
-                if len(ranges) != 360:
-                    logger.warning(f"Scan {timestep} has {len(ranges)} points, expected 360")
-                    # Pad or truncate to 360
-                    if len(ranges) < 360:
-                        ranges.extend([float('inf')] * (360 - len(ranges)))
-                    else:
-                        ranges = ranges[:360]
-                
-                # Format inf values for CSV
-                formatted_ranges = []
-                for r in ranges:
-                    if np.isinf(r) or np.isnan(r) or r <= 0:
-                        formatted_ranges.append('inf')
-                    else:
-                        formatted_ranges.append(f'{r:.5f}')
-                
-                row = [timestep] + formatted_ranges
-                writer.writerow(row)
+        # Invalid readings (inf, nan, non-positive) are all written as inf
+        scan_data = np.where(np.isfinite(scan_data) & (scan_data > 0), scan_data, np.inf)
         
-        logger.info(f"CSV written with {len(scan_data)} scans and 361 columns (timestep + 360 lidar points)")
+        csvfile.write(''.join([CSV_ROW_FORMAT % (timestep, *ranges)
+                               for timestep, ranges in enumerate(scan_data.tolist(), first_timestep)]))
     
     def convert_bag(self, bag_path: str, output_csv: str, topic_filter: Optional[List[str]] = None) -> bool:
         """Convert a ROS bag to TurtleBot CSV format, automatically detecting the format."""
@@ -349,7 +573,7 @@ class TurtleBotLidarBagConverter:
                 return self.convert_ros2_bag(bag_path, output_csv, topic_filter)
             else:
                 logger.warning("ROS 2 libraries not available, using simple conversion")
-                return self.convert_simple_db3(bag_path, output_csv)
+                return self.convert_simple_db3(bag_path, output_csv, topic_filter)
         else:
             logger.error(f"Unknown bag format for: {bag_path}")
             return False